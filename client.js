@@ -17,7 +17,13 @@ class RealTimeVideoClient
             ]
         };
 
+        this.layer = new URLSearchParams(window.location.search).get('layer');
         this.pc = null;
+        this.metadata_channel = null;
+        this.metadata_buffer = [];
+        this.metadata_buffer_limit = 64;
+        // Without frame timestamps, metadata is dispatched as soon as it arrives.
+        this.metadata_sync = 'requestVideoFrameCallback' in HTMLVideoElement.prototype;
     }
 
     print_debug(... args) {
@@ -44,6 +50,8 @@ class RealTimeVideoClient
             self.print_debug('stop() -> timeout()');
             self.pc.close();
             self.pc = null;
+            self.metadata_channel = null;
+            self.metadata_buffer = [];
         }, 500);
     }
 
@@ -82,6 +90,12 @@ class RealTimeVideoClient
             self.on_track(event);
         });
 
+        this.metadata_channel = this.pc.createDataChannel('metadata');
+        this.metadata_channel.binaryType = 'arraybuffer';
+        this.metadata_channel.addEventListener('message', function(event) {
+            self.on_metadata_message(event);
+        });
+
         this.do_negotiate();
     }
 
@@ -89,11 +103,104 @@ class RealTimeVideoClient
         this.print_debug('on_track()');
         if (event.track.kind == 'video') {
             this.video_object.srcObject = event.streams[0];
+            this.watch_video_frames();
         } else if (event.track.kind == 'audio') {
             this.audio_object.srcObject = event.streams[0];
         }
     }
 
+    /**
+     * Each message is the 32-bit big-endian RTP timestamp of the video frame,
+     * followed by the zlib-compressed JSON metadata of that frame.
+     * Messages are buffered until their frame is presented, or dispatched on
+     * arrival if the browser does not report the RTP timestamps of frames.
+     */
+    on_metadata_message(event) {
+        const rtp_timestamp = new DataView(event.data).getUint32(0);
+        const item = {rtp_timestamp: rtp_timestamp, data: event.data.slice(4)};
+        if (!this.metadata_sync) {
+            this.decompress_metadata(item);
+            return;
+        }
+        this.metadata_buffer.push(item);
+        if (this.metadata_buffer.length > this.metadata_buffer_limit) {
+            this.metadata_buffer.shift();
+        }
+    }
+
+    disable_metadata_sync() {
+        this.print_log('disable_metadata_sync() Frame RTP timestamps are not available, metadata is not synchronized');
+        this.metadata_sync = false;
+        const items = this.metadata_buffer;
+        this.metadata_buffer = [];
+        for (const item of items) {
+            this.decompress_metadata(item);
+        }
+    }
+
+    /**
+     * Fixes the layer index of this viewer, or 'auto' to follow the bandwidth estimate.
+     */
+    set_layer(layer) {
+        this.print_debug('set_layer()', layer);
+        this.layer = layer;
+        if (this.metadata_channel && this.metadata_channel.readyState == 'open') {
+            this.metadata_channel.send(JSON.stringify({layer: layer}));
+        }
+    }
+
+    watch_video_frames() {
+        if (!this.metadata_sync) {
+            this.disable_metadata_sync();
+            return;
+        }
+        self = this;
+        this.video_object.requestVideoFrameCallback(function(now, metadata) {
+            self.on_video_frame(metadata);
+            if (self.metadata_sync) {
+                self.watch_video_frames();
+            }
+        });
+    }
+
+    on_video_frame(metadata) {
+        if (metadata.rtpTimestamp === undefined) {
+            this.disable_metadata_sync();
+            return;
+        }
+        // RTP timestamps wrap around at 2^32, so compare them as signed 32-bit differences.
+        while (this.metadata_buffer.length > 0) {
+            const item = this.metadata_buffer[0];
+            const diff = (metadata.rtpTimestamp - item.rtp_timestamp) | 0;
+            if (diff < 0) {
+                break;  // The frame of this message is not presented yet.
+            }
+            this.metadata_buffer.shift();
+            if (diff == 0) {
+                this.decompress_metadata(item);
+            }
+        }
+    }
+
+    decompress_metadata(item) {
+        const stream = new Blob([item.data]).stream()
+            .pipeThrough(new DecompressionStream('deflate'));
+        self = this;
+        return new Response(stream).json()
+            .then(function(metadata) {
+                self.on_metadata(item.rtp_timestamp, metadata);
+            })
+            .catch(function(error) {
+                self.print_error('decompress_metadata()', error);
+            });
+    }
+
+    on_metadata(rtp_timestamp, metadata) {
+        this.video_object.dispatchEvent(new CustomEvent('metadata', {
+            detail: {rtpTimestamp: rtp_timestamp, metadata: metadata}
+        }));
+    }
+
     do_negotiate() {
         this.print_debug('do_negotiate()');
 
@@ -161,6 +268,7 @@ class RealTimeVideoClient
                 body: JSON.stringify({
                     sdp: offer.sdp,
                     type: offer.type,
+                    layer: self.layer,
                 }),
                 headers: {
                     'Content-Type': 'application/json'
@@ -2,6 +2,7 @@
 
 import sys
 import time
+import json
 import argparse
 import psutil
 import numpy as np
@@ -28,20 +29,58 @@ def print_error(message):
     sys.stderr.flush()
 
 
+def collect_children(pid):
+    if not psutil.pid_exists(pid):
+        return []
+    return psutil.Process(pid).children(recursive=True)
+
+
+def kill_children(children):
+    for child in children:
+        try:
+            if child.is_running():
+                print_out(f'kill children: {child.pid}')
+                child.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
 def kill_process(pid):
     if not psutil.pid_exists(pid):
         return
 
     parent = psutil.Process(pid)
 
-    for child in parent.children(recursive=True):
-        print_out(f'kill children: {child.pid}')
-        child.kill()
+    kill_children(parent.children(recursive=True))
 
     print_out(f'Force kill PID: {parent.pid}')
     parent.kill()
 
 
+def _to_json_object(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def encode_metadata(metadata):
+    if metadata is None:
+        return None
+    return json.dumps(metadata, separators=(',', ':'), default=_to_json_object).encode('utf-8')
+
+
+def parse_layers(text):
+    layers = list(map(lambda x: float(x), str(text).split(',')))
+    for scale in layers:
+        if scale <= 0.0:
+            raise ValueError(f'The scale of a layer must be positive: {scale}')
+        if scale > 1.0:
+            print_error(f'parse_layers() The layer scale {scale} upscales the input frame.')
+    return layers
+
+
 class CreateProcessError(Exception):
     pass
 
@@ -68,7 +107,12 @@ class RealTimeVideo:
                  frame_format=vs.DEFAULT_FRAME_FORMAT,
                  cert_file=None,
                  key_file=None,
-                 verbose=False):
+                 verbose=False,
+                 layers=vs.DEFAULT_LAYERS,
+                 workers=vs.DEFAULT_WORKERS,
+                 shared_memory_size=vs.DEFAULT_SHARED_MEMORY_SIZE,
+                 conversion_backend=vs.DEFAULT_CONVERSION_BACKEND,
+                 shared_metadata_size=vs.DEFAULT_SHARED_METADATA_SIZE):
         self.host = host
         self.port = port
         self.ices = ices
@@ -76,6 +120,12 @@ class RealTimeVideo:
         self.exit_timeout_seconds = exit_timeout_seconds
         self.fps = fps
         self.frame_format = frame_format
+        self.layers = layers
+        self.workers = workers
+        self.shared_memory_size = shared_memory_size
+        self.shared_metadata_size = shared_metadata_size
+        self.conversion_backend = conversion_backend
+        self.selected_conversion_backend = None
         self.verbose = verbose
         self.cert_file = cert_file
         self.key_file = key_file
@@ -92,7 +142,7 @@ class RealTimeVideo:
         elif key == 'port':
             self.port = int(val)
         elif key == 'ices':
-            self.ices = list(map(lambda x: x, str(val).split(',')))
+            self.ices = list(filter(lambda x: x, str(val).split(',')))
         elif key == 'max_queue_size':
             self.max_queue_size = int(val)
         elif key == 'exit_timeout_seconds':
@@ -101,6 +151,16 @@ class RealTimeVideo:
             self.fps = int(val)
         elif key == 'frame_format':
             self.frame_format = val
+        elif key == 'layers':
+            self.layers = parse_layers(val)
+        elif key == 'workers':
+            self.workers = int(val) if int(val) >= 1 else 1
+        elif key == 'shared_memory_size':
+            self.shared_memory_size = int(val)
+        elif key == 'shared_metadata_size':
+            self.shared_metadata_size = int(val)
+        elif key == 'conversion_backend':
+            self.conversion_backend = val
         elif key == 'verbose':
             self.verbose = val.lower() in ['y', 'yes', 'true']
 
@@ -119,6 +179,16 @@ class RealTimeVideo:
             return self.fps
         elif key == 'frame_format':
             return self.frame_format
+        elif key == 'layers':
+            return ','.join(list(map(lambda x: str(x), self.layers)))
+        elif key == 'workers':
+            return self.workers
+        elif key == 'shared_memory_size':
+            return self.shared_memory_size
+        elif key == 'shared_metadata_size':
+            return self.shared_metadata_size
+        elif key == 'conversion_backend':
+            return self.selected_conversion_backend or self.conversion_backend
         elif key == 'verbose':
             return self.verbose
 
@@ -136,6 +206,11 @@ class RealTimeVideo:
             pass
 
     def push(self, data):
+        if isinstance(self.queue, vs.SharedFrameStore):
+            # The store only keeps the latest frame, so there is no oldest one to drop.
+            # Raises ValueError if the frame or the metadata does not fit.
+            self.queue.put_nowait(data)
+            return True
         if self._put_nowait(data):
             return True
         self._get_nowait()
@@ -145,12 +220,17 @@ class RealTimeVideo:
         assert self.queue is None
         assert self.process is None
 
-        self.queue = Queue(self.max_queue_size)
+        if self.workers > 1:
+            self.queue = vs.SharedFrameStore(self.shared_memory_size, self.shared_metadata_size)
+        else:
+            self.queue = Queue(self.max_queue_size)
         self.process = Process(target=vs.start_app,
                                args=(self.queue, self.exit_password, self.exit_timeout_seconds,
                                      self.ices, self.host, self.port,
                                      self.fps, self.frame_format,
-                                     self.cert_file, self.key_file, self.verbose,))
+                                     self.cert_file, self.key_file, self.verbose,
+                                     self.layers, self.workers,
+                                     self.selected_conversion_backend or self.conversion_backend,))
         self.process.start()
         if self.process.is_alive():
             self.pid = self.process.pid
@@ -168,6 +248,9 @@ class RealTimeVideo:
             return False
 
     def _close_process_impl(self):
+        # Media workers are children of the server process; remember them before it exits.
+        children = collect_children(self.pid) if self.pid >= 1 else []
+
         if self.process is not None:
             timeout = self.exit_timeout_seconds
             if self.process.is_alive():
@@ -184,14 +267,16 @@ class RealTimeVideo:
 
             if self.process.is_alive():
                 print_error(f'RealTimeVideo._close_process_impl() Send a KILL signal to the server process.')
-                self.process.kill()
+                kill_process(self.pid)
+                self.process.join()
 
         # A negative value -N indicates that the child was terminated by signal N.
         print_out(f'RealTimeVideo._close_process_impl() The exit code of RTC process is {self.process.exitcode}.')
 
         if self.queue is not None:
             self.queue.close()
-            self.queue.cancel_join_thread()
+            if not isinstance(self.queue, vs.SharedFrameStore):
+                self.queue.cancel_join_thread()
             self.queue = None
 
         if self.process is not None:
@@ -202,6 +287,8 @@ class RealTimeVideo:
             kill_process(self.pid)
             self.pid = UNKNOWN_PID
 
+        kill_children(children)
+
         assert self.queue is None
         assert self.process is None
         assert self.pid is UNKNOWN_PID
@@ -237,13 +324,30 @@ class RealTimeVideo:
         else:
             raise CreateProcessError
 
+    def select_conversion_backend(self):
+        self.selected_conversion_backend = None
+        try:
+            if self.conversion_backend == vs.CONVERSION_BACKEND_AUTO:
+                self.selected_conversion_backend = vs.select_conversion_backend(self.frame_format, self.layers)
+            else:
+                # Unknown names and missing optional packages fail here instead of on every offer.
+                vs.create_conversion_backend(self.conversion_backend, self.frame_format)
+                self.selected_conversion_backend = self.conversion_backend
+        except Exception as e:
+            print_error(f'RealTimeVideo.select_conversion_backend() Exception: {e}')
+            return False
+        print_out(f'RealTimeVideo.select_conversion_backend() Selected: {self.selected_conversion_backend}')
+        return True
+
     def on_init(self):
+        if not self.select_conversion_backend():
+            return False
         return self.create_process()
 
     def on_valid(self):
         return self.pid != UNKNOWN_PID
 
-    def on_run(self, image):
+    def on_run(self, image, metadata=None):
         if self.is_reopen():
             self.reopen()
 
@@ -253,7 +357,7 @@ class RealTimeVideo:
         if image.size <= 0:
             raise EmptyDataException
 
-        self.push(image)
+        self.push((image, encode_metadata(metadata)))
 
     def on_destroy(self):
         self._close_process()
@@ -309,12 +413,26 @@ def main():
     parser.add_argument(
         '--ices',
         default=vs.DEFAULT_ICES[0],
-        help=f'ICE servers (default: {vs.DEFAULT_ICES[0]})')
+        help=f'ICE servers, empty for none (default: {vs.DEFAULT_ICES[0]})')
     parser.add_argument(
         '--fps',
         type=int,
         default=vs.DEFAULT_VIDEO_FPS,
         help=f'WebRTC Video FPS (default: {vs.DEFAULT_VIDEO_FPS})')
+    parser.add_argument(
+        '--layers',
+        default=','.join(map(str, vs.DEFAULT_LAYERS)),
+        help=f'Comma separated scale of each video layer (default: {vs.DEFAULT_LAYERS[0]})')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=vs.DEFAULT_WORKERS,
+        help=f'Number of media worker processes (default: {vs.DEFAULT_WORKERS})')
+    parser.add_argument(
+        '--conversion-backend',
+        default=vs.DEFAULT_CONVERSION_BACKEND,
+        choices=[vs.CONVERSION_BACKEND_AUTO] + list(vs.CONVERSION_BACKENDS),
+        help=f'Color conversion and scaling backend (default: {vs.DEFAULT_CONVERSION_BACKEND})')
     parser.add_argument(
         '--verbose',
         '-v',
@@ -325,8 +443,10 @@ def main():
     LOGGING_SUFFIX = '\n'
     vs.LOGGING_SUFFIX = '\n'
 
-    video = RealTimeVideo(host=args.host, port=args.port, ices=[args.ices], fps=args.fps, frame_format='bgr24',
-                          cert_file=args.cert_file, key_file=args.key_file, verbose=bool(args.verbose))
+    layers = parse_layers(args.layers)
+    video = RealTimeVideo(host=args.host, port=args.port, ices=list(filter(lambda x: x, [args.ices])), fps=args.fps, frame_format='bgr24',
+                          layers=layers, workers=args.workers,
+                          conversion_backend=args.conversion_backend, cert_file=args.cert_file, key_file=args.key_file, verbose=bool(args.verbose))
     video.on_init()
 
     import cv2
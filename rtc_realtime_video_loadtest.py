@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import json
+import importlib.util
+import argparse
+import asyncio
+import threading
+import psutil
+import numpy as np
+
+from multiprocessing import Process, Pipe
+from aiohttp import ClientSession
+from aiortc import RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer
+from aiortc.mediastreams import MediaStreamError
+
+import rtc_realtime_video_server as vs
+
+# The lambda lives in 'rtc_realtime_video.app.py', which can not be imported by name.
+_APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rtc_realtime_video.app.py')
+_APP_SPEC = importlib.util.spec_from_file_location('rtc_realtime_video_app', _APP_PATH)
+rtc_realtime_video_app = importlib.util.module_from_spec(_APP_SPEC)
+_APP_SPEC.loader.exec_module(rtc_realtime_video_app)
+
+LOGGING_PREFIX = '[rtc.realtime_video.loadtest] '
+LOGGING_SUFFIX = '\n'
+DEFAULT_LOOPBACK_HOST = '127.0.0.1'
+DEFAULT_PEERS_STEP = 10
+DEFAULT_MAX_PEERS = 200
+DEFAULT_STEP_SECONDS = 10.0
+DEFAULT_KNEE_RATIO = 0.9
+DEFAULT_FRAME_WIDTH = 640
+DEFAULT_FRAME_HEIGHT = 480
+DEFAULT_CLIENT_PROCESSES = 1
+DEFAULT_CLIENT_CPU_LIMIT = 90.0
+DEFAULT_READY_TIMEOUT = 30.0
+READY_INTERVAL = 0.2
+CLIENT_COMMAND_OPEN = 'open'
+CLIENT_COMMAND_SAMPLE = 'sample'
+CLIENT_COMMAND_CLOSE = 'close'
+
+
+def print_out(message):
+    sys.stdout.write(LOGGING_PREFIX + message + LOGGING_SUFFIX)
+    sys.stdout.flush()
+
+
+def print_error(message):
+    sys.stderr.write(LOGGING_PREFIX + message + LOGGING_SUFFIX)
+    sys.stderr.flush()
+
+
+def dict_to_ice_configuration(config: dict):
+    """
+    The reverse of :func:`rtc_realtime_video_server.ice_configuration_to_dict`.
+    An empty ``iceServers`` list is valid and uses host candidates only.
+    """
+
+    ice_servers = [RTCIceServer(**server) for server in config.get('iceServers', [])]
+    return RTCConfiguration(ice_servers)
+
+
+class LoadTestPeer:
+    """
+    Headless viewer that receives and decodes the video track.
+    """
+
+    def __init__(self, index: int, layer=None):
+        self.index = index
+        self.layer = layer
+        self.pc: RTCPeerConnection = None
+        self.frames = 0
+        self.task = None
+
+    async def connect(self, session: ClientSession, url: str, config: RTCConfiguration):
+        self.pc = RTCPeerConnection(config)
+        self.pc.addTransceiver('video', direction='recvonly')
+
+        @self.pc.on('track')
+        def on_track(track):
+            self.task = asyncio.ensure_future(self._consume(track))
+
+        await self.pc.setLocalDescription(await self.pc.createOffer())
+        body = {'sdp': self.pc.localDescription.sdp, 'type': self.pc.localDescription.type, 'layer': self.layer}
+        async with session.post(url + vs.OFFER_PATH, json=body) as response:
+            answer = await response.json()
+        await self.pc.setRemoteDescription(RTCSessionDescription(sdp=answer['sdp'], type=answer['type']))
+
+    async def _consume(self, track):
+        try:
+            while True:
+                await track.recv()
+                self.frames += 1
+        except MediaStreamError:
+            pass
+
+    async def rtp_stats(self):
+        """
+        Returns the received RTP packets and the inter-arrival jitter (milliseconds).
+        """
+
+        packets, jitter = 0, 0.0
+        for receiver in self.pc.getReceivers():
+            for stats in (await receiver.getStats()).values():
+                if stats.type == 'inbound-rtp':
+                    packets += stats.packetsReceived
+                    jitter = max(jitter, stats.jitter * 1000.0 / vs.DEFAULT_VIDEO_CLOCK_RATE)
+        return packets, jitter
+
+    async def close(self):
+        if self.pc is not None:
+            await self.pc.close()
+        if self.task is not None:
+            self.task.cancel()
+
+
+class CpuMonitor:
+    """
+    CPU usage (percent of one core) of a process and, if ``recursive``,
+    all of its children so that the media workers are included.
+    """
+
+    def __init__(self, pid: int, recursive=True):
+        self.pid = pid
+        self.recursive = recursive
+        self.processes = {}
+
+    def _collect(self):
+        if self.pid <= 0 or not psutil.pid_exists(self.pid):
+            return []
+        parent = psutil.Process(self.pid)
+        result = []
+        children = parent.children(recursive=True) if self.recursive else []
+        for process in [parent] + children:
+            result.append(self.processes.setdefault(process.pid, process))
+        return result
+
+    def sample(self):
+        total = 0.0
+        for process in self._collect():
+            try:
+                total += process.cpu_percent(interval=None)
+            except psutil.NoSuchProcess:
+                self.processes.pop(process.pid, None)
+        return total
+
+
+class FrameFeeder(threading.Thread):
+    """
+    Runs synthetic frames and metadata through the lambda, as the pipeline does.
+    """
+
+    def __init__(self, video, width: int, height: int, fps: int):
+        super().__init__(daemon=True)
+        self.video = video
+        self.image = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        self.ptime = 1.0 / float(fps)
+        self.done = threading.Event()
+
+    def run(self):
+        index = 0
+        while not self.done.wait(self.ptime):
+            try:
+                self.video.on_run(np.roll(self.image, index, axis=1), {'index': index})
+            except Exception as e:
+                print_error(f'FrameFeeder.run() Exception: {e}')
+                return
+            index += 1
+
+
+def fetch_config(url: str, timeout: float):
+    """
+    Polls ``/config`` until the server answers, because the conversion
+    benchmark and the media workers delay its startup.
+    """
+
+    import urllib.request
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url + vs.CONFIG_PATH, timeout=READY_INTERVAL) as response:
+                return json.loads(response.read())
+        except OSError:
+            if time.time() >= deadline:
+                raise TimeoutError(f'The server did not answer within {timeout}s: {url}')
+            time.sleep(READY_INTERVAL)
+
+
+class LoadTestClient:
+    """
+    One load generator process. It owns a share of the peers and answers the
+    commands of :class:`LoadTest` through a pipe, so that decoding is spread
+    over several cores.
+    """
+
+    def __init__(self, connection, url: str, config: dict, layer=None):
+        self.connection = connection
+        self.url = url
+        self.config = dict_to_ice_configuration(config)
+        self.layer = layer
+        self.peers = []
+
+    async def _open_peers(self, session: ClientSession, count: int):
+        new_peers = [LoadTestPeer(len(self.peers) + i, self.layer) for i in range(count)]
+        self.peers.extend(new_peers)
+        await asyncio.gather(*[peer.connect(session, self.url, self.config) for peer in new_peers])
+
+    async def _sample(self):
+        stats = await asyncio.gather(*[peer.rtp_stats() for peer in self.peers])
+        return [(peer.frames, packets, jitter) for peer, (packets, jitter) in zip(self.peers, stats)]
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        async with ClientSession() as session:
+            try:
+                while True:
+                    command, value = await loop.run_in_executor(None, self.connection.recv)
+                    if command == CLIENT_COMMAND_OPEN:
+                        await self._open_peers(session, value)
+                        self.connection.send(len(self.peers))
+                    elif command == CLIENT_COMMAND_SAMPLE:
+                        self.connection.send(await self._sample())
+                    else:
+                        break
+            finally:
+                await asyncio.gather(*[peer.close() for peer in self.peers])
+
+
+def run_client(connection, url: str, config: dict, layer=None):
+    try:
+        asyncio.run(LoadTestClient(connection, url, config, layer).run())
+    except Exception as e:
+        print_error(f'run_client() Exception: {e}')
+    finally:
+        connection.close()
+
+
+class LoadTest:
+    """
+    Ramps up the number of headless viewers and reports the frame rate,
+    jitter and CPU usage of each step, and the knee point where the mean
+    frame rate falls below ``knee_ratio * fps``.
+
+    A drop of the frame rate while a client process is at ``client_cpu_limit``
+    measures the load generator rather than the server, so no knee point is
+    declared in that case.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.url = f'http://{args.host}:{args.port}'
+        self.clients = []
+        self.client_peers = []
+        self.results = []
+
+    @property
+    def peers(self):
+        return sum(self.client_peers)
+
+    def _start_clients(self, config: dict):
+        for _ in range(max(1, self.args.client_processes)):
+            connection, client_connection = Pipe()
+            process = Process(target=run_client,
+                              args=(client_connection, self.url, config, self.args.layer,),
+                              daemon=True)
+            process.start()
+            self.clients.append((process, connection))
+            self.client_peers.append(0)
+
+    def _stop_clients(self):
+        for process, connection in self.clients:
+            try:
+                connection.send((CLIENT_COMMAND_CLOSE, None))
+            except OSError:
+                pass
+        for process, connection in self.clients:
+            process.join(timeout=vs.DEFAULT_EXIT_TIMEOUT_SECONDS)
+            if process.is_alive():
+                process.kill()
+            connection.close()
+        self.clients.clear()
+
+    def _open_peers(self, count: int):
+        counts = [0] * len(self.clients)
+        for _ in range(count):
+            index = min(range(len(self.clients)), key=lambda i: self.client_peers[i] + counts[i])
+            counts[index] += 1
+        for (_, connection), value in zip(self.clients, counts):
+            connection.send((CLIENT_COMMAND_OPEN, value))
+        for index, (_, connection) in enumerate(self.clients):
+            self.client_peers[index] = connection.recv()
+
+    def _sample(self):
+        for _, connection in self.clients:
+            connection.send((CLIENT_COMMAND_SAMPLE, None))
+        result = []
+        for _, connection in self.clients:
+            result.extend(connection.recv())
+        return result
+
+    def _measure(self, server_cpu: CpuMonitor, client_cpus: list):
+        time.sleep(self.args.warmup_seconds)
+
+        begin = self._sample()
+        begin_time = time.time()
+        server_cpu.sample()
+        for client_cpu in client_cpus:
+            client_cpu.sample()
+
+        time.sleep(self.args.step_seconds)
+
+        end = self._sample()
+        elapsed = time.time() - begin_time
+        server_percent = server_cpu.sample()
+        client_percent = max(client_cpu.sample() for client_cpu in client_cpus)
+        fps = [(e[0] - b[0]) / elapsed for b, e in zip(begin, end)]
+        return {
+            'peers': len(end),
+            'fps_mean': float(np.mean(fps)),
+            'fps_min': float(np.min(fps)),
+            'jitter_ms': float(np.mean([e[2] for e in end])),
+            'packets': int(sum(e[1] - b[1] for b, e in zip(begin, end))),
+            'server_cpu': server_percent,
+            'client_cpu': client_percent,
+        }
+
+    def _print_result(self, result):
+        print_out('peers={peers:4d} fps_mean={fps_mean:6.2f} fps_min={fps_min:6.2f} jitter={jitter_ms:7.2f}ms '
+                  'packets={packets:8d} server_cpu={server_cpu:6.1f}% client_cpu={client_cpu:6.1f}%'.format(**result))
+
+    def run(self, server_pid: int):
+        config = fetch_config(self.url, self.args.ready_timeout)
+        server_cpu = CpuMonitor(server_pid)
+        knee = None
+        saturated = None
+        self._start_clients(config)
+        client_cpus = [CpuMonitor(process.pid, recursive=False) for process, _ in self.clients]
+        try:
+            while self.peers < self.args.max_peers:
+                self._open_peers(min(self.args.peers_step, self.args.max_peers - self.peers))
+                result = self._measure(server_cpu, client_cpus)
+                self.results.append(result)
+                self._print_result(result)
+                if result['fps_mean'] >= self.args.fps * self.args.knee_ratio:
+                    continue
+                if result['client_cpu'] >= self.args.client_cpu_limit:
+                    saturated = result
+                else:
+                    knee = result
+                break
+        finally:
+            self._stop_clients()
+        if knee:
+            print_out(f'Knee point: {knee["peers"]} peers (fps_mean={knee["fps_mean"]:.2f})')
+        elif saturated:
+            print_error(f'No knee point: the load generator is saturated at {saturated["peers"]} peers '
+                        f'(client_cpu={saturated["client_cpu"]:.1f}%). Increase --client-processes.')
+        else:
+            print_out(f'No knee point up to {self.peers} peers')
+        return knee
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RealTimeVideo load test')
+    parser.add_argument(
+        '--host',
+        default=DEFAULT_LOOPBACK_HOST,
+        help=f'Host of the server (default: {DEFAULT_LOOPBACK_HOST})')
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=vs.DEFAULT_PORT,
+        help=f'Port of the server (default: {vs.DEFAULT_PORT})')
+    parser.add_argument(
+        '--fps',
+        type=int,
+        default=vs.DEFAULT_VIDEO_FPS,
+        help=f'Expected video FPS of the server (default: {vs.DEFAULT_VIDEO_FPS})')
+    parser.add_argument(
+        '--layer',
+        type=int,
+        help='Video layer index requested by each peer (default: follow the bandwidth estimate)')
+    parser.add_argument(
+        '--peers-step',
+        type=int,
+        default=DEFAULT_PEERS_STEP,
+        help=f'Number of peers added at each step (default: {DEFAULT_PEERS_STEP})')
+    parser.add_argument(
+        '--max-peers',
+        type=int,
+        default=DEFAULT_MAX_PEERS,
+        help=f'Upper limit on the number of peers (default: {DEFAULT_MAX_PEERS})')
+    parser.add_argument(
+        '--step-seconds',
+        type=float,
+        default=DEFAULT_STEP_SECONDS,
+        help=f'Measuring time of each step (default: {DEFAULT_STEP_SECONDS})')
+    parser.add_argument(
+        '--warmup-seconds',
+        type=float,
+        default=2.0,
+        help='Waiting time before measuring each step (default: 2.0)')
+    parser.add_argument(
+        '--knee-ratio',
+        type=float,
+        default=DEFAULT_KNEE_RATIO,
+        help=f'Stop when the mean FPS falls below this ratio of --fps (default: {DEFAULT_KNEE_RATIO})')
+    parser.add_argument(
+        '--client-processes',
+        type=int,
+        default=DEFAULT_CLIENT_PROCESSES,
+        help=f'Number of load generator processes sharing the peers (default: {DEFAULT_CLIENT_PROCESSES})')
+    parser.add_argument(
+        '--client-cpu-limit',
+        type=float,
+        default=DEFAULT_CLIENT_CPU_LIMIT,
+        help=f'CPU usage of a load generator process regarded as saturated (default: {DEFAULT_CLIENT_CPU_LIMIT})')
+    parser.add_argument(
+        '--ready-timeout',
+        type=float,
+        default=DEFAULT_READY_TIMEOUT,
+        help=f'Waiting time for the server to answer {vs.CONFIG_PATH} (default: {DEFAULT_READY_TIMEOUT})')
+    parser.add_argument(
+        '--pid',
+        type=int,
+        help='PID of an already running server, for the CPU curve')
+    parser.add_argument(
+        '--spawn-server',
+        action='store_true',
+        help='Start a server fed with synthetic frames on loopback, without any ICE server')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=vs.DEFAULT_WORKERS,
+        help=f'Number of media workers of the spawned server (default: {vs.DEFAULT_WORKERS})')
+    parser.add_argument(
+        '--conversion-backend',
+        default=vs.DEFAULT_CONVERSION_BACKEND,
+        choices=[vs.CONVERSION_BACKEND_AUTO] + list(vs.CONVERSION_BACKENDS),
+        help=f'Conversion backend of the spawned server (default: {vs.DEFAULT_CONVERSION_BACKEND})')
+    parser.add_argument(
+        '--width',
+        type=int,
+        default=DEFAULT_FRAME_WIDTH,
+        help=f'Width of the synthetic frames (default: {DEFAULT_FRAME_WIDTH})')
+    parser.add_argument(
+        '--height',
+        type=int,
+        default=DEFAULT_FRAME_HEIGHT,
+        help=f'Height of the synthetic frames (default: {DEFAULT_FRAME_HEIGHT})')
+    parser.add_argument(
+        '--verbose',
+        '-v',
+        action='count',
+        help='Print the logs of the server module')
+    args = parser.parse_args()
+
+    vs.LOGGING_SUFFIX = '\n'
+    rtc_realtime_video_app.LOGGING_SUFFIX = '\n'
+    if not args.verbose:
+        vs.print_out = vs.print_null
+        rtc_realtime_video_app.print_out = vs.print_null
+
+    video = None
+    feeder = None
+    server_pid = args.pid or 0
+
+    if args.spawn_server:
+        # An empty ICE server list keeps the whole test on loopback host candidates.
+        video = rtc_realtime_video_app.RealTimeVideo(host=args.host, port=args.port, ices=[], fps=args.fps,
+                                                     workers=args.workers,
+                                                     shared_memory_size=args.width * args.height * 3,
+                                                     conversion_backend=args.conversion_backend)
+        if not video.on_init():
+            print_error('The server could not be started')
+            sys.exit(1)
+        server_pid = video.pid
+        feeder = FrameFeeder(video, args.width, args.height, args.fps)
+        feeder.start()
+
+    try:
+        LoadTest(args).run(server_pid)
+    finally:
+        if video is not None:
+            feeder.done.set()
+            feeder.join()
+            video.on_destroy()
+
+
+if __name__ == '__main__':
+    main()
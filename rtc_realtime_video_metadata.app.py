@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import os
+import importlib.util
+
+# The implementation lives in 'rtc_realtime_video.app.py', which can not be imported by name.
+_APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rtc_realtime_video.app.py')
+_APP_SPEC = importlib.util.spec_from_file_location('rtc_realtime_video_app', _APP_PATH)
+rtc_realtime_video_app = importlib.util.module_from_spec(_APP_SPEC)
+_APP_SPEC.loader.exec_module(rtc_realtime_video_app)
+
+
+MAIN_HANDLER = rtc_realtime_video_app.RealTimeVideo()
+
+
+def on_set(key, val):
+    MAIN_HANDLER.on_set(key, val)
+
+
+def on_get(key):
+    return MAIN_HANDLER.on_get(key)
+
+
+def on_init():
+    return MAIN_HANDLER.on_init()
+
+
+def on_valid():
+    return MAIN_HANDLER.on_valid()
+
+
+def on_run(image, metadata):
+    return MAIN_HANDLER.on_run(image, metadata)
+
+
+def on_destroy():
+    return MAIN_HANDLER.on_destroy()
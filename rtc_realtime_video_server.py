@@ -5,18 +5,25 @@ import sys
 import string
 import random
 import ssl
+import socket
 import time
 import dataclasses
 import json
 import fractions
 import asyncio
+import itertools
+import struct
+import zlib
 import av
 import numpy as np
-from typing import Tuple
 from queue import Empty
+from multiprocessing import Process, shared_memory
 from aiohttp import web
 from aiortc import RTCPeerConnection, RTCSessionDescription, RTCIceServer, RTCConfiguration
+from aiortc import RTCRtpSender
 from aiortc.mediastreams import MediaStreamTrack, MediaStreamError
+from aiortc.rtp import RtcpPsfbPacket, RTCP_PSFB_APP, unpack_remb_fci
+from aiortc.codecs.vpx import number_of_threads
 
 INDEX_HTML_PATH = '/'
 CLIENT_JS_PATH = '/client.js'
@@ -33,6 +40,36 @@ DEFAULT_ICES = ('stun:stun.l.google.com:19302',)
 DEFAULT_VIDEO_CLOCK_RATE = 90000
 DEFAULT_VIDEO_FPS = 12
 DEFAULT_FRAME_FORMAT = 'bgr24'
+DEFAULT_LAYERS = (1.0,)
+LAYER_FRAME_FORMAT = 'yuv420p'
+LAYER_PARAM_KEY = 'layer'
+LAYER_AUTO = 'auto'
+LAYER_CODEC_MIME_TYPES = ('video/VP8', 'video/rtx')
+DEFAULT_LAYER_BITRATE = 1000000  # Bitrate of a 1.0 scale layer, in bits per second.
+MIN_LAYER_BITRATE = 150000
+LAYER_SWITCH_DOWN_RATIO = 0.8
+LAYER_SWITCH_UP_RATIO = 1.2
+LAYER_SWITCH_UP_INTERVAL = 10.0
+DEFAULT_WORKERS = 1
+DEFAULT_SHARED_MEMORY_SIZE = 3840 * 2160 * 3
+DEFAULT_SHARED_METADATA_SIZE = 64 * 1024
+WORKER_HOST = '127.0.0.1'
+WORKER_STARTUP_TIMEOUT = 8.0
+WORKER_STARTUP_INTERVAL = 0.1
+SHARED_HEADER_FIELDS = 5  # sequence, height, width, channels, metadata size
+SHARED_HEADER_SIZE = SHARED_HEADER_FIELDS * np.dtype(np.int64).itemsize
+METADATA_CHANNEL_LABEL = 'metadata'
+METADATA_RTP_TIMESTAMP_FORMAT = '!I'
+SENDER_RTP_TIMESTAMP_ATTRIBUTE = '_RTCRtpSender__rtp_timestamp'
+METADATA_MAX_BUFFERED_AMOUNT = 256 * 1024
+METADATA_COMPRESS_LEVEL = zlib.Z_BEST_SPEED
+CONVERSION_BACKEND_AUTO = 'auto'
+DEFAULT_CONVERSION_BACKEND = CONVERSION_BACKEND_AUTO
+DEFAULT_SWSCALE_INTERPOLATION = 'FAST_BILINEAR'
+DEFAULT_SWSCALE_THREADS = 0  # Automatic selection based on the number of CPUs.
+BENCHMARK_FRAME_WIDTH = 640
+BENCHMARK_FRAME_HEIGHT = 480
+BENCHMARK_REPEAT = 5
 LOGGING_PREFIX = '[rtc.realtime_video.server] '
 LOGGING_SUFFIX = ''
 
@@ -85,7 +122,8 @@ def ice_url_to_ice_server(ice_url: str):
 
 
 def ice_urls_to_servers(ice_urls: list):
-    return list(filter(lambda x: x, [ice_url_to_ice_server(i) for i in ice_urls]))
+    # An empty URL (e.g. from an empty ``ices`` prop) means no ICE server; host candidates only.
+    return list(filter(lambda x: x, [ice_url_to_ice_server(i) for i in ice_urls if i]))
 
 
 def ice_urls_to_configuration(ice_urls: list):
@@ -144,65 +182,587 @@ class Singleton:
         return cls.__instance
 
 
+class SharedFrameStore:
+    """
+    The latest frame and its metadata in shared memory, written by the lambda
+    process and read by every media worker process.
+
+    It mimics the ``put_nowait``/``get_nowait`` part of :class:`multiprocessing.Queue`,
+    but only ever holds the latest frame: ``put_nowait`` overwrites it and
+    never blocks. The sequence number is odd while a frame is being written,
+    so a reader that copied a torn frame drops it and retries on the next tick.
+    """
+
+    def __init__(self, size=DEFAULT_SHARED_MEMORY_SIZE, metadata_size=DEFAULT_SHARED_METADATA_SIZE, name=None):
+        if name:
+            self.memory = shared_memory.SharedMemory(name=name)
+        else:
+            self.memory = shared_memory.SharedMemory(
+                create=True, size=SHARED_HEADER_SIZE + metadata_size + size)
+        self.owner = not name
+        self.header = np.ndarray((SHARED_HEADER_FIELDS,), dtype=np.int64, buffer=self.memory.buf)
+        self.metadata = np.ndarray((metadata_size,), dtype=np.uint8,
+                                   buffer=self.memory.buf, offset=SHARED_HEADER_SIZE)
+        self.data = np.ndarray((self.memory.size - SHARED_HEADER_SIZE - metadata_size,), dtype=np.uint8,
+                               buffer=self.memory.buf, offset=SHARED_HEADER_SIZE + metadata_size)
+        self.last_sequence = 0
+
+    def __reduce__(self):
+        return self.__class__, (0, self.metadata.size, self.memory.name)
+
+    def put_nowait(self, item):
+        image, metadata = item
+        metadata = metadata or b''
+        if image.nbytes > self.data.size:
+            raise ValueError(f'The frame ({image.nbytes} bytes) exceeds the shared memory ({self.data.size} bytes)')
+        if len(metadata) > self.metadata.size:
+            raise ValueError(f'The metadata ({len(metadata)} bytes) exceeds '
+                             f'the shared metadata memory ({self.metadata.size} bytes)')
+        height, width = image.shape[:2]
+        channels = image.shape[2] if image.ndim > 2 else 1
+        self.header[0] += 1
+        self.header[1:] = (height, width, channels, len(metadata))
+        self.metadata[:len(metadata)] = np.frombuffer(metadata, dtype=np.uint8)
+        self.data[:image.nbytes] = np.ascontiguousarray(image, dtype=np.uint8).reshape(-1)
+        self.header[0] += 1
+
+    def get_nowait(self):
+        sequence = int(self.header[0])
+        if sequence % 2 == 1 or sequence == self.last_sequence:
+            raise Empty
+        height, width, channels, metadata_size = (int(x) for x in self.header[1:])
+        # The header itself may be torn, so check the bounds before slicing.
+        if min(height, width, channels) <= 0 or height * width * channels > self.data.size:
+            raise Empty
+        if metadata_size < 0 or metadata_size > self.metadata.size:
+            raise Empty
+        image = self.data[:height * width * channels].reshape(height, width, channels).copy()
+        metadata = self.metadata[:metadata_size].tobytes() if metadata_size else None
+        if int(self.header[0]) != sequence:
+            raise Empty
+        self.last_sequence = sequence
+        return image, metadata
+
+    def close(self):
+        # The shared buffer can not be released while the numpy views export it.
+        self.header = None
+        self.metadata = None
+        self.data = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def _even(value: int):
+    return max(2, value - value % 2)
+
+
+class SwscaleConversion:
+    """
+    Converts with libswscale through PyAV, using a fast interpolation and
+    sliced multi-threaded scaling.
+    """
+
+    name = 'swscale'
+
+    def __init__(self, frame_format=DEFAULT_FRAME_FORMAT,
+                 interpolation=DEFAULT_SWSCALE_INTERPOLATION,
+                 threads=DEFAULT_SWSCALE_THREADS):
+        self.frame_format = frame_format
+        self.options = {'interpolation': interpolation, 'threads': threads}
+        try:
+            self.convert(np.zeros((2, 2, 3), dtype=np.uint8), 2, 2)
+        except TypeError:
+            # PyAV older than the ``threads`` argument.
+            del self.options['threads']
+
+    def convert(self, image, width: int, height: int):
+        frame = av.VideoFrame.from_ndarray(image, format=self.frame_format)
+        frame = frame.reformat(width=width, height=height, format=LAYER_FRAME_FORMAT, **self.options)
+        return frame.to_ndarray()
+
+
+class OpenCVConversion:
+    """
+    Converts with OpenCV, which uses SIMD kernels for both steps.
+    Raises :class:`ImportError` if OpenCV is not installed.
+    """
+
+    name = 'opencv'
+
+    def __init__(self, frame_format=DEFAULT_FRAME_FORMAT):
+        import cv2
+        self.cv2 = cv2
+        self.code = cv2.COLOR_RGB2YUV_I420 if frame_format == 'rgb24' else cv2.COLOR_BGR2YUV_I420
+
+    def convert(self, image, width: int, height: int):
+        if image.shape[1] != width or image.shape[0] != height:
+            downscale = width < image.shape[1]
+            interpolation = self.cv2.INTER_AREA if downscale else self.cv2.INTER_LINEAR
+            image = self.cv2.resize(image, (width, height), interpolation=interpolation)
+        return self.cv2.cvtColor(image, self.code)
+
+
+class NumpyConversion:
+    """
+    Reference implementation: nearest-neighbor scaling and BT.601
+    limited-range conversion with 2x2 averaged chroma.
+    """
+
+    name = 'numpy'
+
+    def __init__(self, frame_format=DEFAULT_FRAME_FORMAT):
+        self.channels = (0, 1, 2) if frame_format == 'rgb24' else (2, 1, 0)
+        self.indices = {}
+
+    def _resize(self, image, width: int, height: int):
+        source_height, source_width = image.shape[:2]
+        if source_width == width and source_height == height:
+            return image
+        key = (source_width, source_height, width, height)
+        if key not in self.indices:
+            self.indices[key] = (np.arange(height) * source_height // height,
+                                 np.arange(width) * source_width // width)
+        rows, cols = self.indices[key]
+        return image[rows[:, None], cols]
+
+    def convert(self, image, width: int, height: int):
+        image = self._resize(image, width, height).astype(np.int32)
+        r, g, b = (image[..., i] for i in self.channels)
+        y = ((66 * r + 129 * g + 25 * b + 128) >> 8) + 16
+
+        def _subsample(plane):
+            return (plane[0::2, 0::2] + plane[0::2, 1::2] + plane[1::2, 0::2] + plane[1::2, 1::2] + 2) >> 2
+
+        r, g, b = _subsample(r), _subsample(g), _subsample(b)
+        u = ((-38 * r - 74 * g + 112 * b + 128) >> 8) + 128
+        v = ((112 * r - 94 * g - 18 * b + 128) >> 8) + 128
+        planes = [y.reshape(-1), u.reshape(-1), v.reshape(-1)]
+        return np.concatenate(planes).astype(np.uint8).reshape(height * 3 // 2, width)
+
+
+CONVERSION_BACKENDS = {
+    SwscaleConversion.name: SwscaleConversion,
+    OpenCVConversion.name: OpenCVConversion,
+    NumpyConversion.name: NumpyConversion,
+}
+
+
+def create_conversion_backend(name: str, frame_format=DEFAULT_FRAME_FORMAT):
+    if name not in CONVERSION_BACKENDS:
+        raise ValueError(f'Unknown conversion backend: {name}')
+    return CONVERSION_BACKENDS[name](frame_format)
+
+
+# The numpy reference implementation scales by nearest neighbor, which aliases
+# downscaled layers, so it is never chosen by the benchmark.
+AUTO_CONVERSION_BACKENDS = (SwscaleConversion.name, OpenCVConversion.name)
+
+
+def select_conversion_backend(frame_format=DEFAULT_FRAME_FORMAT, layers=DEFAULT_LAYERS,
+                              width=BENCHMARK_FRAME_WIDTH, height=BENCHMARK_FRAME_HEIGHT,
+                              repeat=BENCHMARK_REPEAT):
+    """
+    Returns the name of the fastest available backend for converting
+    every layer of a ``width`` x ``height`` frame on this machine.
+    Backends that fail to load or to convert are skipped.
+    """
+
+    image = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    sizes = [(_even(int(width * scale)), _even(int(height * scale))) for scale in layers or DEFAULT_LAYERS]
+    elapsed = {}
+    for name in AUTO_CONVERSION_BACKENDS:
+        try:
+            backend = create_conversion_backend(name, frame_format)
+            for size in sizes:
+                backend.convert(image, *size)  # Warm up caches and lazy initialization.
+            begin = time.perf_counter()
+            for _ in range(repeat):
+                for size in sizes:
+                    backend.convert(image, *size)
+            elapsed[name] = time.perf_counter() - begin
+        except Exception as e:
+            print_error(f'select_conversion_backend() Skip {name}: {e}')
+    print_out(f'select_conversion_backend({elapsed})')
+    if not elapsed:
+        raise RuntimeError('No conversion backend is available')
+    return min(elapsed, key=elapsed.get)
+
+
+try:
+    KEYFRAME_PICTURE_TYPE = av.video.frame.PictureType.I
+except AttributeError:
+    KEYFRAME_PICTURE_TYPE = 'I'  # PyAV older than the ``PictureType`` enum.
+
+
+def layer_bitrate(scale: float):
+    return max(MIN_LAYER_BITRATE, int(DEFAULT_LAYER_BITRATE * scale * scale))
+
+
+def select_layer_by_bitrate(layers, layer: int, bitrate: int, upgrade=False):
+    """
+    Returns the layer to send for the estimated ``bitrate`` of a peer.
+
+    The largest layer that fits the estimate replaces a current layer
+    that no longer does. Otherwise, if ``upgrade`` is set and the estimate
+    leaves enough headroom, the next larger layer is probed.
+    """
+
+    if bitrate < layer_bitrate(layers[layer]) * LAYER_SWITCH_DOWN_RATIO:
+        fits = [i for i in range(len(layers)) if layer_bitrate(layers[i]) <= bitrate]
+        if fits:
+            return max(fits, key=lambda i: layers[i])
+        return min(range(len(layers)), key=lambda i: layers[i])
+    if upgrade and bitrate >= layer_bitrate(layers[layer]) * LAYER_SWITCH_UP_RATIO:
+        larger = [i for i in range(len(layers)) if layers[i] > layers[layer]]
+        if larger:
+            return min(larger, key=lambda i: layers[i])
+    return layer
+
+
+@dataclasses.dataclass
+class EncodedLayerFrame:
+    data: bytes
+    keyframe: bool
+    index: int  # Position in the encoded stream of the layer.
+    tick: int
+    pts: int
+    sequence: int  # FrameQueue.sequence of the encoded image.
+    metadata: bytes = None
+
+
+class LayerEncoder:
+    """
+    VP8 encoder of one layer. Every track watching the layer sends the same
+    encoded frames, which the :class:`RTCRtpSender` of each peer only
+    packetizes, so a frame is encoded once no matter how many peers watch it.
+
+    The settings follow the realtime settings of aiortc's own encoder, except
+    that the bitrate is fixed per layer: peers adapt by switching layers.
+    """
+
+    def __init__(self, bitrate=DEFAULT_LAYER_BITRATE):
+        self.bitrate = bitrate
+        self.codec = None
+        self.force_keyframe = True
+        self.index = 0
+
+    def request_keyframe(self):
+        self.force_keyframe = True
+
+    def take_keyframe_request(self):
+        force_keyframe, self.force_keyframe = self.force_keyframe, False
+        return force_keyframe
+
+    def _create_codec(self, width: int, height: int):
+        codec = av.CodecContext.create('libvpx', 'w')
+        codec.width = width
+        codec.height = height
+        codec.bit_rate = self.bitrate
+        codec.pix_fmt = LAYER_FRAME_FORMAT
+        codec.time_base = fractions.Fraction(1, DEFAULT_VIDEO_CLOCK_RATE)
+        codec.gop_size = 3000  # Keyframes are only sent on request.
+        codec.qmin = 2
+        codec.qmax = 56
+        codec.options = {
+            'bufsize': str(self.bitrate),
+            'cpu-used': '-6',
+            'deadline': 'realtime',
+            'lag-in-frames': '0',
+            'minrate': str(self.bitrate),
+            'maxrate': str(self.bitrate),
+            'noise-sensitivity': '4',
+            'overshoot-pct': '15',
+            'partitions': '0',
+            'static-thresh': '1',
+            'undershoot-pct': '100',
+        }
+        codec.thread_count = number_of_threads(width * height, os.cpu_count() or 1)
+        return codec
+
+    def encode(self, image, pts: int, force_keyframe=False):
+        """
+        Returns ``(data, keyframe, index)``, or ``None`` if the rate control
+        dropped the frame.
+        """
+
+        frame = av.VideoFrame.from_ndarray(image, format=LAYER_FRAME_FORMAT)
+        frame.pts = pts
+        frame.time_base = fractions.Fraction(1, DEFAULT_VIDEO_CLOCK_RATE)
+        if self.codec and (frame.width != self.codec.width or frame.height != self.codec.height):
+            self.codec = None
+        if self.codec is None:
+            self.codec = self._create_codec(frame.width, frame.height)
+            force_keyframe = True
+        if force_keyframe:
+            frame.pict_type = KEYFRAME_PICTURE_TYPE
+        packets = self.codec.encode(frame)
+        if not packets:
+            return None
+        self.index += 1
+        return b''.join(bytes(p) for p in packets), any(p.is_keyframe for p in packets), self.index
+
+
 class FrameQueue(Singleton):
+    """
+    The latest frame shared by every track of the server process.
+
+    Each layer is a scaled copy of the latest frame, converted to ``yuv420p``
+    and encoded by its own :class:`LayerEncoder`. The tracks share one clock
+    of ``fps`` ticks, and each layer is converted and encoded at most once
+    per tick, no matter how many peers are watching it.
+
+    Queue items are ``(image, metadata)`` tuples, where ``metadata`` is
+    JSON encoded bytes or ``None``. ``conversion_backend`` is a backend
+    name or an instance built by :func:`create_conversion_backend`.
+    """
 
-    def __init__(self, queue):
+    def __init__(self, queue, frame_format=DEFAULT_FRAME_FORMAT, layers=DEFAULT_LAYERS,
+                 conversion_backend=SwscaleConversion.name, fps=DEFAULT_VIDEO_FPS):
         self.EMPTY_IMAGE = np.zeros((300, 300, 3), dtype=np.uint8)
         self.queue = queue
+        self.frame_format = frame_format
+        self.layers = tuple(layers) if layers else DEFAULT_LAYERS
+        if isinstance(conversion_backend, str):
+            self.conversion = create_conversion_backend(conversion_backend, frame_format)
+        else:
+            self.conversion = conversion_backend
         self.last_image = self.EMPTY_IMAGE
+        self.last_metadata = None
+        self.layer_images = {}
+        self.compressed_metadata = None
+        self.sequence = 0
+        self.fps = fps
+        self.start = time.time()
+        self.encoders = {}
+        self.encoded_frames = {}
 
     def pop(self):
         try:
-            self.last_image = self.queue.get_nowait()
+            self.last_image, self.last_metadata = self.queue.get_nowait()
+            self.layer_images.clear()
+            self.compressed_metadata = None
+            self.sequence += 1
         except Empty:
             pass
         return self.last_image
 
+    def compress_metadata(self):
+        if self.last_metadata is None:
+            return None
+        if self.compressed_metadata is None:
+            self.compressed_metadata = zlib.compress(self.last_metadata, METADATA_COMPRESS_LEVEL)
+        return self.compressed_metadata
+
+    def _convert_layer(self, image, scale: float):
+        height, width = image.shape[:2]
+        return self.conversion.convert(image, _even(int(width * scale)), _even(int(height * scale)))
+
+    def pop_layer(self, layer: int):
+        image = self.pop()
+        if layer not in self.layer_images:
+            self.layer_images[layer] = self._convert_layer(image, self.layers[layer])
+        return self.layer_images[layer]
+
+    async def next_tick(self, last_tick: int):
+        tick = max(int((time.time() - self.start) * self.fps) + 1, last_tick + 1)
+        wait = self.start + tick / self.fps - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return tick
+
+    def _encoder(self, layer: int):
+        if layer not in self.encoders:
+            self.encoders[layer] = LayerEncoder(layer_bitrate(self.layers[layer]))
+        return self.encoders[layer]
+
+    def request_keyframe(self, layer: int):
+        self._encoder(layer).request_keyframe()
+
+    async def _encode_layer(self, layer: int, tick: int, previous):
+        if previous is not None:
+            # An encoder is not reentrant, and its frames must stay in order.
+            await asyncio.wait([previous])
+        image = self.pop_layer(layer)
+        sequence = self.sequence
+        metadata = self.compress_metadata()
+        pts = int(tick * DEFAULT_VIDEO_CLOCK_RATE / self.fps)
+        encoder = self._encoder(layer)
+        force_keyframe = encoder.take_keyframe_request()
+        result = await asyncio.get_event_loop().run_in_executor(
+            None, encoder.encode, image, pts, force_keyframe)
+        if result is None:
+            return None
+        data, keyframe, index = result
+        return EncodedLayerFrame(data, keyframe, index, tick, pts, sequence, metadata)
+
+    async def encode_layer(self, layer: int, tick: int):
+        """
+        Returns the :class:`EncodedLayerFrame` of ``layer`` at ``tick`` (or a
+        later tick already encoded), or ``None`` if the encoder dropped it.
+        The first track asking for a tick encodes it and the others await it.
+        """
+
+        previous = self.encoded_frames.get(layer)
+        if previous is not None and previous[0] >= tick:
+            return await previous[1]
+        future = asyncio.ensure_future(self._encode_layer(layer, tick, previous[1] if previous else None))
+        self.encoded_frames[layer] = (tick, future)
+        return await future
+
 
 class VideoImageTrack(MediaStreamTrack):
     """
     Video track to get the last frame.
+
+    The track returns the VP8 packets of its layer, encoded once for every
+    peer by :class:`FrameQueue`. It only starts, or changes layers, on a
+    keyframe. The keyframe requests (PLI/FIR) and the bandwidth estimates
+    (REMB) of its peer are taken from the sender, and in ``adaptive`` mode
+    the estimates choose the layer.
+
+    If a metadata channel is attached, the metadata of each new frame is sent
+    on it as the big-endian 32-bit RTP timestamp of the frame followed by the
+    zlib-compressed JSON, so that the client can match it with the frame it
+    renders.
     """
 
     kind = 'video'
+    rtp_timestamp_warned = False
 
-    _start: float
-    _timestamp: int
-
-    def __init__(self, queue, fps=DEFAULT_VIDEO_FPS, frame_format=DEFAULT_FRAME_FORMAT, verbose=False):
+    def __init__(self, queue, fps=DEFAULT_VIDEO_FPS, frame_format=DEFAULT_FRAME_FORMAT, verbose=False,
+                 layers=DEFAULT_LAYERS, layer=0, conversion_backend=SwscaleConversion.name, adaptive=False):
         super().__init__()  # don't forget this!
-        self.queue = FrameQueue.instance(queue)
+        self.queue = FrameQueue.instance(queue, frame_format, layers, conversion_backend, fps)
         self.frame_format = frame_format
+        self.layers = tuple(layers) if layers else DEFAULT_LAYERS
+        self.layer = layer
+        self.adaptive = adaptive
+        self.layer_time = time.time()
+        self.tick = -1
+        self.index = None  # Index of the last frame sent on the layer, None until a keyframe.
+        self.sender = None
+        self.channel = None
+        self.metadata_sequence = 0
+        self.pending_metadata = None
+        self.last_pts = None
+        self.rtp_timestamp_origin = None
         self.fps = fps
-        self.ptime = 1.0 / float(fps)
         self.video_clock_rate = DEFAULT_VIDEO_CLOCK_RATE
         # The unit of time (in fractional seconds) in which timestamps are expressed.
         self.video_time_base = fractions.Fraction(1, self.video_clock_rate)
         self.verbose = verbose
-        print_out(f'VideoImageTrack(fps={fps},frame_format={frame_format},verbose={verbose})')
-
-    async def next_timestamp(self) -> Tuple[int, fractions.Fraction]:
-        if self.readyState != 'live':
-            raise MediaStreamError
-
-        if hasattr(self, '_timestamp'):
-            self._timestamp += int(self.ptime * self.video_clock_rate)
-            wait = self._start + (self._timestamp / self.video_clock_rate) - time.time()
-            await asyncio.sleep(wait)
-        else:
-            self._start = time.time()
-            self._timestamp = 0
-        return self._timestamp, self.video_time_base
+        print_out(f'VideoImageTrack(fps={fps},frame_format={frame_format},layer={layer},adaptive={adaptive},verbose={verbose})')
+
+    def attach_sender(self, sender: RTCRtpSender):
+        self.sender = sender
+        sender._send_keyframe = self.request_keyframe
+        handle_rtcp_packet = sender._handle_rtcp_packet
+
+        async def _handle_rtcp_packet(packet):
+            if isinstance(packet, RtcpPsfbPacket) and packet.fmt == RTCP_PSFB_APP:
+                try:
+                    bitrate, _ = unpack_remb_fci(packet.fci)
+                    self.on_bitrate(bitrate)
+                except ValueError:
+                    pass
+            await handle_rtcp_packet(packet)
+
+        sender._handle_rtcp_packet = _handle_rtcp_packet
+
+    def request_keyframe(self):
+        self.index = None
+
+    def select_layer(self, layer: int):
+        layer = min(max(layer, 0), len(self.layers) - 1)
+        if layer == self.layer:
+            return
+        print_out(f'VideoImageTrack.select_layer({self.layer} -> {layer})')
+        self.layer = layer
+        self.layer_time = time.time()
+        self.index = None
+
+    def on_bitrate(self, bitrate: int):
+        if not self.adaptive:
+            return
+        upgrade = time.time() - self.layer_time >= LAYER_SWITCH_UP_INTERVAL
+        self.select_layer(select_layer_by_bitrate(self.layers, self.layer, bitrate, upgrade))
+
+    def _is_channel_open(self):
+        return self.channel is not None and self.channel.readyState == 'open'
+
+    def _get_rtp_timestamp_origin(self):
+        """
+        The random RTP timestamp origin of the sender, worked out once from
+        its last RTP timestamp: the sender only calls :meth:`recv` after every
+        packet of the previous frame went out, so that timestamp is the origin
+        plus the PTS of that frame.
+        """
+
+        if self.rtp_timestamp_origin is not None or self.last_pts is None or self.sender is None:
+            return self.rtp_timestamp_origin
+        rtp_timestamp = getattr(self.sender, SENDER_RTP_TIMESTAMP_ATTRIBUTE, None)
+        if rtp_timestamp is None:
+            if not VideoImageTrack.rtp_timestamp_warned:
+                VideoImageTrack.rtp_timestamp_warned = True
+                print_error(f'VideoImageTrack._get_rtp_timestamp_origin() '
+                            f'RTCRtpSender has no {SENDER_RTP_TIMESTAMP_ATTRIBUTE}, metadata is not sent')
+            return None
+        if rtp_timestamp == 0:
+            return None  # Nothing was sent yet.
+        self.rtp_timestamp_origin = (rtp_timestamp - self.last_pts) & 0xFFFFFFFF
+        return self.rtp_timestamp_origin
+
+    def send_metadata(self):
+        """
+        Sends the metadata of the previous frame, tagged with the RTP timestamp
+        of that frame. The frame already went out, so the metadata never leads
+        the video on the wire.
+        """
+
+        origin = self._get_rtp_timestamp_origin()
+        pending, self.pending_metadata = self.pending_metadata, None
+        if pending is None or origin is None or not self._is_channel_open():
+            return
+        if self.channel.bufferedAmount > METADATA_MAX_BUFFERED_AMOUNT:
+            if self.verbose:
+                print_out(f'VideoImageTrack.send_metadata() Drop: bufferedAmount={self.channel.bufferedAmount}')
+            return
+        pts, payload = pending
+        rtp_timestamp = (origin + pts) & 0xFFFFFFFF
+        self.channel.send(struct.pack(METADATA_RTP_TIMESTAMP_FORMAT, rtp_timestamp) + payload)
+
+    async def _next_encoded_frame(self):
+        while True:
+            if self.readyState != 'live':
+                raise MediaStreamError
+            self.tick = await self.queue.next_tick(self.tick)
+            if self.index is None:
+                self.queue.request_keyframe(self.layer)
+            encoded = await self.queue.encode_layer(self.layer, self.tick)
+            if encoded is None:
+                continue
+            self.tick = encoded.tick
+            if encoded.keyframe or (self.index is not None and encoded.index == self.index + 1):
+                self.index = encoded.index
+                return encoded
+            # The peer misses a frame this one refers to; wait for a keyframe.
+            self.index = None
 
     async def recv(self):
-        pts, time_base = await self.next_timestamp()
-        image = self.queue.pop()
-        frame = av.VideoFrame.from_ndarray(image, format=self.frame_format)
-        frame.pts = pts
-        frame.time_base = time_base
+        self.send_metadata()
+        encoded = await self._next_encoded_frame()
+        packet = av.Packet(encoded.data)
+        packet.pts = encoded.pts
+        packet.time_base = self.video_time_base
+        self.last_pts = encoded.pts
+        if self.metadata_sequence != encoded.sequence and self._is_channel_open():
+            self.metadata_sequence = encoded.sequence
+            if encoded.metadata is not None:
+                self.pending_metadata = encoded.pts, encoded.metadata
         if self.verbose:
-            print_out(f'VideoImageTrack.recv(frame={frame})')
-        return frame
+            print_out(f'VideoImageTrack.recv(layer={self.layer},packet={packet})')
+        return packet
 
 
 class RealTimeVideoServer:
@@ -220,7 +780,10 @@ class RealTimeVideoServer:
                  frame_format=DEFAULT_FRAME_FORMAT,
                  cert_file=None,
                  key_file=None,
-                 verbose=False):
+                 verbose=False,
+                 layers=DEFAULT_LAYERS,
+                 conversion_backend=DEFAULT_CONVERSION_BACKEND,
+                 sock=None):
         self.ROOT_DIR = os.path.dirname(__file__)
         self.INDEX_HTML_CONTENT = open(os.path.join(self.ROOT_DIR, 'index.html'), 'r').read()
         self.CLIENT_JS_CONTENT = open(os.path.join(self.ROOT_DIR, 'client.js'), 'r').read()
@@ -233,10 +796,18 @@ class RealTimeVideoServer:
         self.port = port
         self.fps = fps
         self.frame_format = frame_format
+        self.layers = tuple(layers) if layers else DEFAULT_LAYERS
+        if conversion_backend == CONVERSION_BACKEND_AUTO:
+            self.conversion_backend = select_conversion_backend(frame_format, self.layers)
+        else:
+            self.conversion_backend = conversion_backend
+        # Fails here, before any offer, on an unknown or unavailable backend.
+        self.conversion = create_conversion_backend(self.conversion_backend, frame_format)
         self.backlog = 128
         self.cert_file = cert_file
         self.key_file = key_file
         self.verbose = verbose
+        self.sock = sock
 
         if self.cert_file and self.key_file:
             self.ssl_context = ssl.SSLContext()
@@ -271,6 +842,8 @@ class RealTimeVideoServer:
 
         print_out(f'RealTimeVideoServer() constructor done')
         if verbose:
+            print_out(f' - LAYERS: {self.layers}')
+            print_out(f' - CONVERSION BACKEND: {self.conversion_backend}')
             print_out(f' - ICES: {self.rtc_config}')
             print_out(f' - ICE JSON: {self.rtc_config_json}')
 
@@ -302,11 +875,41 @@ class RealTimeVideoServer:
         print_out(f'RealTimeVideoServer.on_config(remote={request.remote})')
         return web.Response(content_type='application/json', text=self.rtc_config_json)
 
+    def _select_layer(self, value):
+        """
+        Returns ``(layer, adaptive)``. Without a layer index, the track starts
+        on the largest layer and follows the bandwidth estimate of the peer.
+        """
+
+        try:
+            layer = int(value)
+        except (TypeError, ValueError):
+            return max(range(len(self.layers)), key=lambda i: self.layers[i]), True
+        return min(max(layer, 0), len(self.layers) - 1), False
+
+    def _on_layer_message(self, video_tracks, message):
+        try:
+            value = json.loads(message)[LAYER_PARAM_KEY]
+        except (TypeError, ValueError, KeyError) as e:
+            print_error(f'RealTimeVideoServer._on_layer_message() Invalid message: {e}')
+            return
+        for video_track in video_tracks:
+            layer, video_track.adaptive = self._select_layer(value)
+            if not video_track.adaptive:
+                video_track.select_layer(layer)
+
+    @staticmethod
+    def _set_layer_codec(transceiver):
+        # Shared layer encoders produce VP8, which every WebRTC endpoint supports.
+        codecs = RTCRtpSender.getCapabilities('video').codecs
+        transceiver.setCodecPreferences([c for c in codecs if c.mimeType in LAYER_CODEC_MIME_TYPES])
+
     async def on_offer(self, request):
         print_out(f'RealTimeVideoServer.on_offer(remote={request.remote})')
 
         params = await request.json()
         offer = RTCSessionDescription(sdp=params['sdp'], type=params['type'])
+        layer, adaptive = self._select_layer(params.get(LAYER_PARAM_KEY))
 
         pc = RTCPeerConnection(self.rtc_config)
         self.peer_connections.add(pc)
@@ -332,17 +935,55 @@ class RealTimeVideoServer:
         if self.verbose:
             print_out(f'- OFFER: {offer}')
 
+        try:
+            await self._answer(pc, offer, layer, adaptive)
+        except Exception as e:
+            print_error(f'RealTimeVideoServer.on_offer() Exception: {e}')
+            await pc.close()
+            self.peer_connections.discard(pc)
+            return web.Response(status=500)
+
+        return web.Response(
+            content_type='application/json',
+            text=json.dumps(
+                {
+                    'sdp': pc.localDescription.sdp,
+                    'type': pc.localDescription.type
+                }
+            ),
+        )
+
+    async def _answer(self, pc: RTCPeerConnection, offer: RTCSessionDescription, layer: int, adaptive: bool):
         await pc.setRemoteDescription(offer)
 
+        video_tracks = []
         for t in pc.getTransceivers():
             if t.kind == 'video':
-                pc.addTrack(VideoImageTrack(queue=self.queue,
-                                            fps=self.fps,
-                                            frame_format=self.frame_format,
-                                            verbose=self.verbose))
+                self._set_layer_codec(t)
+                video_track = VideoImageTrack(queue=self.queue,
+                                              fps=self.fps,
+                                              frame_format=self.frame_format,
+                                              layers=self.layers,
+                                              layer=layer,
+                                              conversion_backend=self.conversion,
+                                              adaptive=adaptive,
+                                              verbose=self.verbose)
+                video_tracks.append(video_track)
+                video_track.attach_sender(pc.addTrack(video_track))
             elif t.kind == 'audio':
                 pass
 
+        @pc.on('datachannel')
+        def on_datachannel(channel):
+            print_out(f'on_datachannel({channel.label})')
+            if channel.label == METADATA_CHANNEL_LABEL:
+                for video_track in video_tracks:
+                    video_track.channel = channel
+
+                @channel.on('message')
+                def on_message(message):
+                    self._on_layer_message(video_tracks, message)
+
         answer = await pc.createAnswer()
 
         if self.verbose:
@@ -350,16 +991,6 @@ class RealTimeVideoServer:
 
         await pc.setLocalDescription(answer)
 
-        return web.Response(
-            content_type='application/json',
-            text=json.dumps(
-                {
-                    'sdp': pc.localDescription.sdp,
-                    'type': pc.localDescription.type
-                }
-            ),
-        )
-
     async def on_shutdown(self, app):
         print_out(f'RealTimeVideoServer.on_shutdown()')
         # close peer connections
@@ -371,9 +1002,11 @@ class RealTimeVideoServer:
         print_out(f'RealTimeVideoServer.on_cleanup()')
 
     def run(self):
+        # A worker serves a socket bound by its front-end instead of host/port.
         web.run_app(app=self.app,
-                    host=self.host,
-                    port=self.port,
+                    host=None if self.sock else self.host,
+                    port=None if self.sock else self.port,
+                    sock=self.sock,
                     shutdown_timeout=self.exit_timeout,
                     ssl_context=self.ssl_context,
                     print=print_null,
@@ -381,6 +1014,129 @@ class RealTimeVideoServer:
                     handle_signals=False)
 
 
+class RealTimeVideoProxyServer(RealTimeVideoServer):
+    """
+    Signaling front-end that shares the peer connections across several
+    media worker processes.
+
+    Each worker is a :class:`RealTimeVideoServer` serving a loopback socket
+    bound by the front-end to a port chosen by the OS, so that workers never
+    collide with other servers on adjacent ports. Offers are forwarded to the workers
+    in a round-robin manner, and the media then flows directly between the
+    viewer and the worker. All workers read the same :class:`SharedFrameStore`.
+    """
+
+    def __init__(self,
+                 queue,
+                 exit_password: str,
+                 exit_timeout=DEFAULT_EXIT_TIMEOUT_SECONDS,
+                 ices=DEFAULT_ICES,
+                 host=DEFAULT_HOST,
+                 port=DEFAULT_PORT,
+                 fps=DEFAULT_VIDEO_FPS,
+                 frame_format=DEFAULT_FRAME_FORMAT,
+                 cert_file=None,
+                 key_file=None,
+                 verbose=False,
+                 layers=DEFAULT_LAYERS,
+                 workers=DEFAULT_WORKERS,
+                 conversion_backend=DEFAULT_CONVERSION_BACKEND):
+        super().__init__(queue, exit_password, exit_timeout,
+                         ices, host, port, fps, frame_format,
+                         cert_file, key_file, verbose,
+                         layers, conversion_backend)
+        self.workers = workers
+        self.worker_ports = []
+        self.worker_port_cycle = None
+        self.worker_processes = {}
+        self.session = None
+        self.app.on_startup.append(self.on_startup)
+        print_out(f'RealTimeVideoProxyServer(workers={self.workers}) constructor done')
+
+    async def _wait_worker(self, worker_port: int):
+        import aiohttp
+        url = f'http://{WORKER_HOST}:{worker_port}{CONFIG_PATH}'
+        deadline = time.time() + WORKER_STARTUP_TIMEOUT
+        while time.time() < deadline and self.worker_processes[worker_port].is_alive():
+            try:
+                async with self.session.get(url) as response:
+                    if response.status == 200:
+                        return True
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(WORKER_STARTUP_INTERVAL)
+        print_error(f'RealTimeVideoProxyServer._wait_worker() Worker is not ready: {worker_port}')
+        return False
+
+    async def on_startup(self, app):
+        print_out(f'RealTimeVideoProxyServer.on_startup()')
+        import aiohttp
+        self.session = aiohttp.ClientSession()
+        for _ in range(self.workers):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((WORKER_HOST, 0))
+            worker_port = sock.getsockname()[1]
+            process = Process(target=start_app,
+                              args=(self.queue, self.exit_password, self.exit_timeout,
+                                    self.ices, WORKER_HOST, worker_port,
+                                    self.fps, self.frame_format,
+                                    None, None, self.verbose,
+                                    self.layers, DEFAULT_WORKERS, self.conversion_backend,
+                                    sock,))
+            process.start()
+            sock.close()
+            self.worker_ports.append(worker_port)
+            self.worker_processes[worker_port] = process
+        self.worker_port_cycle = itertools.cycle(self.worker_ports)
+        print_out(f'RealTimeVideoProxyServer.on_startup() Worker ports: {self.worker_ports}')
+        # The site starts accepting offers after every startup handler is done.
+        await asyncio.gather(*[self._wait_worker(worker_port) for worker_port in self.worker_ports])
+
+    async def on_offer(self, request):
+        import aiohttp
+        body = await request.read()
+        for _ in self.worker_ports:
+            worker_port = next(self.worker_port_cycle)
+            if not self.worker_processes[worker_port].is_alive():
+                continue
+            print_out(f'RealTimeVideoProxyServer.on_offer(remote={request.remote},worker={worker_port})')
+            url = f'http://{WORKER_HOST}:{worker_port}{OFFER_PATH}'
+            try:
+                async with self.session.post(url, data=body,
+                                             headers={'Content-Type': 'application/json'}) as response:
+                    text = await response.text()
+                    status = response.status
+            except aiohttp.ClientError as e:
+                print_error(f'RealTimeVideoProxyServer.on_offer() Worker {worker_port} exception: {e}')
+                continue
+            return web.Response(status=status, content_type='application/json', text=text)
+        print_error(f'RealTimeVideoProxyServer.on_offer() No worker is available.')
+        return web.Response(status=503)
+
+    def _close_worker(self, process: Process, worker_port: int):
+        if process.is_alive():
+            request_begin = time.time()
+            if not request_exit(WORKER_HOST, worker_port, self.exit_password, self.exit_timeout):
+                print_error(f'RealTimeVideoProxyServer._close_worker() Exit request failure: {worker_port}')
+            timeout = self.exit_timeout - (time.time() - request_begin)
+            process.join(timeout=timeout if timeout >= 0.0 else 0.0)
+        if process.is_alive():
+            print_error(f'RealTimeVideoProxyServer._close_worker() Send a KILL signal: {worker_port}')
+            process.kill()
+            process.join()
+
+    async def on_shutdown(self, app):
+        print_out(f'RealTimeVideoProxyServer.on_shutdown()')
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, self._close_worker, process, worker_port)
+                               for worker_port, process in self.worker_processes.items()])
+        self.worker_processes.clear()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
 def start_app(queue,
               exit_password: str,
               exit_timeout=DEFAULT_EXIT_TIMEOUT_SECONDS,
@@ -391,14 +1147,25 @@ def start_app(queue,
               frame_format=DEFAULT_FRAME_FORMAT,
               cert_file=None,
               key_file=None,
-              verbose=False):
-    args_text = 'host={},port={},fps={},format={},cert={},key={},verbose={}'.format(
-        host, port, fps, frame_format, cert_file, key_file, verbose)
+              verbose=False,
+              layers=DEFAULT_LAYERS,
+              workers=DEFAULT_WORKERS,
+              conversion_backend=DEFAULT_CONVERSION_BACKEND,
+              sock=None):
+    args_text = 'host={},port={},fps={},format={},layers={},cert={},key={},verbose={},workers={},conversion={}'.format(
+        host, port, fps, frame_format, layers, cert_file, key_file, verbose, workers, conversion_backend)
     print_out(f'start_app({args_text}) BEGIN')
     try:
-        server = RealTimeVideoServer(queue, exit_password, exit_timeout,
-                                     ices, host, port, fps, frame_format,
-                                     cert_file, key_file, verbose)
+        if workers > 1:
+            server = RealTimeVideoProxyServer(queue, exit_password, exit_timeout,
+                                              ices, host, port, fps, frame_format,
+                                              cert_file, key_file, verbose,
+                                              layers, workers, conversion_backend)
+        else:
+            server = RealTimeVideoServer(queue, exit_password, exit_timeout,
+                                         ices, host, port, fps, frame_format,
+                                         cert_file, key_file, verbose,
+                                         layers, conversion_backend, sock)
         server.run()
     except web.GracefulExit:
         print_out(f'RealTimeVideoServer Graceful Exit')
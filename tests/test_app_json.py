@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VIDEO_APP_JSON = os.path.join(ROOT_DIR, 'rtc_realtime_video.app.json')
+METADATA_APP_JSON = os.path.join(ROOT_DIR, 'rtc_realtime_video_metadata.app.json')
+OWN_INFO_KEYS = ('name', 'titles', 'descriptions')
+
+
+def _load(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_metadata_lambda_props_follow_video_lambda():
+    # The metadata lambda runs the same implementation, so only its identity and input differ.
+    video = _load(VIDEO_APP_JSON)
+    metadata = _load(METADATA_APP_JSON)
+    assert metadata['props'] == video['props']
+    for key in OWN_INFO_KEYS:
+        del video['info'][key]
+        del metadata['info'][key]
+    assert metadata['info'] == video['info']
+    assert metadata['controls']['input'] == [video['controls']['input'], 'metadata']
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+import rtc_realtime_video_server as vs
+
+WIDTH = 64
+HEIGHT = 48
+COLORS = [(0, 0, 0), (255, 255, 255), (0, 0, 255), (0, 255, 0), (255, 0, 0), (30, 120, 200)]
+
+
+def _flat(color):
+    image = np.empty((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    image[:] = color
+    return image
+
+
+@pytest.mark.parametrize('color', COLORS)
+@pytest.mark.parametrize('scale', [1.0, 0.5])
+def test_numpy_matches_opencv(color, scale):
+    pytest.importorskip('cv2')
+    width, height = vs._even(int(WIDTH * scale)), vs._even(int(HEIGHT * scale))
+    expected = vs.OpenCVConversion().convert(_flat(color), width, height)
+    result = vs.NumpyConversion().convert(_flat(color), width, height)
+    assert result.shape == expected.shape == (height * 3 // 2, width)
+    assert np.abs(result.astype(np.int16) - expected.astype(np.int16)).max() <= 1
+
+
+def test_rgb24_channel_order():
+    bgr = vs.NumpyConversion('bgr24').convert(_flat((255, 0, 0)), WIDTH, HEIGHT)
+    rgb = vs.NumpyConversion('rgb24').convert(_flat((0, 0, 255)), WIDTH, HEIGHT)
+    assert np.array_equal(bgr, rgb)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        vs.create_conversion_backend('foo')
+
+
+def test_auto_selection_skips_reference_and_broken_backends(monkeypatch):
+    def broken(self, image, width, height):
+        raise RuntimeError('broken')
+
+    monkeypatch.setattr(vs.OpenCVConversion, 'convert', broken)
+    assert vs.select_conversion_backend(width=WIDTH, height=HEIGHT, repeat=1) == vs.SwscaleConversion.name
+
+    monkeypatch.setattr(vs.SwscaleConversion, 'convert', broken)
+    with pytest.raises(RuntimeError):
+        vs.select_conversion_backend(width=WIDTH, height=HEIGHT, repeat=1)
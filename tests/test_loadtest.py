@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import socket
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('aiortc')
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOADTEST_PATH = os.path.join(ROOT_DIR, 'rtc_realtime_video_loadtest.py')
+LOADTEST_TIMEOUT = 120.0
+MAX_PEERS = 2
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_spawned_server_streams_offline(workers):
+    # The spawned server gets no ICE servers, so this must pass without network access.
+    result = subprocess.run([sys.executable, LOADTEST_PATH,
+                             '--spawn-server',
+                             '--port', str(_free_port()),
+                             '--max-peers', str(MAX_PEERS),
+                             '--peers-step', '1',
+                             '--step-seconds', '2',
+                             '--warmup-seconds', '1',
+                             '--workers', str(workers),
+                             '--width', '320',
+                             '--height', '240'],
+                            cwd=ROOT_DIR, capture_output=True, text=True, timeout=LOADTEST_TIMEOUT)
+    assert result.returncode == 0, result.stderr
+
+    steps = re.findall(r'peers=\s*(\d+) fps_mean=\s*([\d.]+)', result.stdout + result.stderr)
+    assert [int(peers) for peers, _ in steps] == list(range(1, MAX_PEERS + 1))
+    assert all(float(fps) > 0 for _, fps in steps)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+import numpy as np
+import pytest
+
+from queue import Empty
+
+import rtc_realtime_video_server as vs
+
+
+@pytest.fixture
+def store():
+    writer = vs.SharedFrameStore(64 * 48 * 3, 1024)
+    yield writer
+    writer.close()
+
+
+@pytest.fixture
+def reader(store):
+    # Workers receive the store pickled by name, like a multiprocessing argument.
+    result = pickle.loads(pickle.dumps(store))
+    yield result
+    result.close()
+
+
+def _image(value=7):
+    return np.full((48, 64, 3), value, dtype=np.uint8)
+
+
+def test_round_trip(store, reader):
+    store.put_nowait((_image(), b'{"a":1}'))
+    image, metadata = reader.get_nowait()
+    assert np.array_equal(image, _image())
+    assert metadata == b'{"a":1}'
+    assert not reader.owner
+
+
+def test_no_metadata(store, reader):
+    store.put_nowait((_image(), None))
+    _, metadata = reader.get_nowait()
+    assert metadata is None
+
+
+def test_latest_frame_only(store, reader):
+    store.put_nowait((_image(1), None))
+    store.put_nowait((_image(2), None))
+    image, _ = reader.get_nowait()
+    assert image[0, 0, 0] == 2
+    with pytest.raises(Empty):
+        reader.get_nowait()
+
+
+def test_odd_sequence(store, reader):
+    store.put_nowait((_image(), None))
+    store.header[0] += 1  # A writer in the middle of a frame.
+    with pytest.raises(Empty):
+        reader.get_nowait()
+
+
+@pytest.mark.parametrize('field, value', [
+    (1, 1 << 40),  # height
+    (2, 0),  # width
+    (4, -1),  # metadata size
+    (4, 1 << 20),
+])
+def test_torn_header(store, reader, field, value):
+    store.put_nowait((_image(), b'{}'))
+    store.header[field] = value
+    with pytest.raises(Empty):
+        reader.get_nowait()
+
+
+def test_oversize(store):
+    with pytest.raises(ValueError):
+        store.put_nowait((np.zeros((480, 640, 3), dtype=np.uint8), None))
+    with pytest.raises(ValueError):
+        store.put_nowait((_image(), b'x' * 2048))